@@ -3,15 +3,30 @@ Fraud Detection Dashboard
 Displays: (1) Duplicate records, (2) Credit Note / Invoice ratios
 Data source: CSV export from Athena GENERATE_IRN query
 
-Run: python app.py
+Run: python app.py            (waitress, 8 threads)
+     python app.py --debug    (Flask dev server with reloader)
 Open: http://localhost:5000
 """
 
 import csv
+import io
 import json
+import mmap
 import os
-from collections import defaultdict
-from flask import Flask, render_template_string, jsonify, request as flask_request, send_file
+import pickle
+import sys
+import tempfile
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
+from operator import itemgetter
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+import orjson
+from flask import Flask, Response, request as flask_request, send_file
 
 app = Flask(__name__)
 
@@ -19,6 +34,10 @@ DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
 CSV_PATH = os.path.join(DATA_DIR, "duplicates.csv")
 CRN_RATIO_PATH = os.path.join(DATA_DIR, "crn_ratio.json")
 FULL_CSV = os.path.join(DATA_DIR, "1 Month Data.csv")
+DUP_CACHE_PATH = os.path.join(DATA_DIR, ".duplicates.cache.pkl")
+STATS_PATH = os.path.join(DATA_DIR, "stats.json")
+CSV_READ_BUFFER = 1 << 20
+EXPORT_CHUNK_ROWS = 1000
 
 KEY_COLS = ["BuyerDtls_Gstin", "SellerDtls_Gstin", "DocDtls_Dt", "DocDtls_No"]
 
@@ -33,83 +52,208 @@ DISPLAY_COLS_PREFERRED = [
     "CustomFields_ErpSource"
 ]
 
+CRN_SORT_COLS = {0: "_row_num", 2: "gstin", 3: "name", 4: "crn_inv_ratio",
+                 5: "inv_count", 6: "crn_count", 7: "dbn_count",
+                 8: "total_inv_val", 9: "total_crn_val"}
+
+# Bump whenever the layout of the on-disk caches changes.
+CACHE_FORMAT = 1
+_CACHE_VERSION = "%d-%08x" % (
+    CACHE_FORMAT, zlib.crc32(repr((KEY_COLS, DISPLAY_COLS_PREFERRED)).encode("utf-8")))
+
 _cache = {}
 
 
+def _data_mtimes():
+    return [os.path.getmtime(p) if os.path.exists(p) else 0
+            for p in (CSV_PATH, CRN_RATIO_PATH)]
+
+
+@contextmanager
+def _file_lock(path):
+    try:
+        lock_file = open(path, "a")
+    except OSError:
+        yield
+        return
+    with lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def _read_pickle_cache(path, mtime):
+    try:
+        with open(path, "rb") as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            payload = pickle.loads(mm)
+    except Exception:
+        return None
+    if (not isinstance(payload, dict) or payload.get("mtime") != mtime
+            or payload.get("version") != _CACHE_VERSION):
+        return None
+    return payload
+
+
+def _replace_file(path, write):
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def _write_pickle_cache(path, payload):
+    _replace_file(path, lambda f: pickle.dump(payload, f, protocol=5))
+
+
 def load_duplicates():
-    if "dup_rows" in _cache:
-        return _cache["dup_rows"], _cache["dup_display_cols"], _cache["dup_stats"]
+    entry = _load_dup_entry()
+    if entry is None:
+        return [], [], {}
+    return entry[1:]
+
 
+def _load_dup_entry():
     if not os.path.exists(CSV_PATH):
-        return [], [], {}
+        return None
+
+    mtime = os.path.getmtime(CSV_PATH)
+    entry = _cache.get("dup")
+    if entry is not None and entry[0] == mtime:
+        return entry
+
+    with _file_lock(DUP_CACHE_PATH + ".lock"):
+        cached = _read_pickle_cache(DUP_CACHE_PATH, mtime)
+        if cached is None:
+            parsed = _parse_duplicates()
+            if parsed is None:
+                return None
+            dup_rows, display_cols, stats = parsed
+            cached = {"mtime": mtime, "version": _CACHE_VERSION, "rows": dup_rows,
+                      "cols": display_cols, "stats": stats}
+            _write_pickle_cache(DUP_CACHE_PATH, cached)
+
+    entry = (mtime, cached["rows"], cached["cols"], cached["stats"])
+    _cache["dup"] = entry
+    return entry
+
+
+def _parse_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return 0.0
 
-    rows = []
+
+def _parse_duplicates():
+    groups = {}
     try:
-        with open(CSV_PATH, "r", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            columns = reader.fieldnames or []
-            for row in reader:
-                rows.append(row)
+        with open(CSV_PATH, "r", encoding="utf-8", newline="",
+                  buffering=CSV_READ_BUFFER) as f:
+            reader = csv.reader(f)
+            columns = next(reader, [])
+
+            display_cols = [c for c in DISPLAY_COLS_PREFERRED if c in columns]
+            used_cols = set(KEY_COLS) | set(display_cols)
+            keep = [(j, c) for j, c in enumerate(columns) if c in used_cols]
+
+            if all(k in columns for k in KEY_COLS):
+                key_idx = [columns.index(k) for k in KEY_COLS]
+                width = max(key_idx) + 1
+                get_key = itemgetter(*key_idx)
+                strip = str.strip
+
+                def row_key(values):
+                    if len(values) < width:
+                        return None
+                    vals = tuple(map(strip, get_key(values)))
+                    # No key field contains \x01, so joined keys sort like tuples.
+                    return "\x01".join(vals) if all(vals) else None
+
+                counts = Counter(filter(None, map(row_key, reader)))
+                groups = {key: [] for key, n in counts.items() if n > 1}
+                del counts
+
+                f.seek(0)
+                reader = csv.reader(f)
+                next(reader, None)
+                for values in reader:
+                    bucket = groups.get(row_key(values))
+                    if bucket is not None:
+                        bucket.append({c: values[j] for j, c in keep if j < len(values)})
     except Exception:
-        return [], [], {}
+        return None
 
-    display_cols = [c for c in DISPLAY_COLS_PREFERRED if c in columns]
-
-    groups = defaultdict(list)
-    for i, row in enumerate(rows):
-        vals = [(row.get(k) or "").strip() for k in KEY_COLS]
-        if all(vals):
-            key = tuple(vals)
-            groups[key].append(i)
-
-    dup_rows = []
-    group_id = 0
-    total_value = 0.0
-    unique_sellers = set()
-
-    for key in sorted(groups.keys()):
-        indices = groups[key]
-        if len(indices) <= 1:
-            continue
-        for idx in indices:
-            row = rows[idx]
+    dup_groups = [groups[key] for key in sorted(groups)]
+    dup_rows = [None] * sum(map(len, dup_groups))
+    pos = 0
+
+    for group_id, group in enumerate(dup_groups):
+        size = len(group)
+        for row in group:
+            # NUL-separated so a search never matches across two columns.
+            row["_search_blob"] = "\0".join(v.lower() for v in row.values() if v)
             row["_group_id"] = group_id
-            row["_group_size"] = len(indices)
-            dup_rows.append(row)
-            try:
-                total_value += float(row.get("ValDtls_TotInvVal") or 0)
-            except (ValueError, TypeError):
-                pass
-            s = (row.get("SellerDtls_Gstin") or "").strip()
-            if s:
-                unique_sellers.add(s)
-        group_id += 1
+            row["_group_size"] = size
+            out = {k: (v if v else "-") for k, v in row.items() if not k.startswith("_")}
+            out["_group_id"] = group_id
+            out["_group_size"] = size
+            row["_json"] = orjson.dumps(out)[:-1]
+            dup_rows[pos] = row
+            pos += 1
+
+    inv_vals = list(filter(None, (row.get("ValDtls_TotInvVal") for row in dup_rows)))
+    try:
+        total_value = sum(map(float, inv_vals), 0.0)
+    except ValueError:
+        total_value = sum(map(_parse_float, inv_vals), 0.0)
+
+    unique_sellers = {row["SellerDtls_Gstin"].strip() for row in dup_rows}
 
     stats = {
         "total_rows": len(dup_rows),
-        "num_groups": group_id,
+        "num_groups": len(dup_groups),
         "total_value": total_value,
         "unique_sellers": len(unique_sellers),
     }
 
-    _cache["dup_rows"] = dup_rows
-    _cache["dup_display_cols"] = display_cols
-    _cache["dup_stats"] = stats
     return dup_rows, display_cols, stats
 
 
 def load_crn_ratios():
-    if "crn_data" in _cache:
-        return _cache["crn_data"], _cache["crn_stats"]
+    entry = _load_crn_entry()
+    if entry is None:
+        return [], {}
+    return entry[1], entry[2]
 
+
+def _load_crn_entry():
     if not os.path.exists(CRN_RATIO_PATH):
-        return [], {}
+        return None
+
+    mtime = os.path.getmtime(CRN_RATIO_PATH)
+    entry = _cache.get("crn")
+    if entry is not None and entry[0] == mtime:
+        return entry
 
     try:
         with open(CRN_RATIO_PATH, "r") as f:
             data = json.load(f)
     except Exception:
-        return [], {}
+        return None
+
+    for r in data:
+        r["_gstin_lc"] = (r.get("gstin") or "").lower()
+        r["_name_lc"] = (r.get("name") or "").lower()
 
     stats = {
         "total_sellers": len(data),
@@ -117,10 +261,53 @@ def load_crn_ratios():
         "extreme_ratio": sum(1 for x in data if x.get("crn_inv_ratio", 0) > 1.0),
         "total_crn_val": sum(x.get("total_crn_val", 0) for x in data),
     }
+    orders = {
+        (key, order_dir): sorted(data, key=lambda x, key=key: x.get(key, 0),
+                                 reverse=(order_dir == "desc"))
+        for key in set(CRN_SORT_COLS.values()) - {"_row_num"}
+        for order_dir in ("asc", "desc")
+    }
+
+    entry = (mtime, data, stats, orders)
+    _cache["crn"] = entry
+    return entry
 
-    _cache["crn_data"] = data
-    _cache["crn_stats"] = stats
-    return data, stats
+
+# The returned list is shared and must not be modified.
+@lru_cache(maxsize=64)
+def _crn_view(search, sort_key, order_dir, mtime):
+    _, data, _, orders = _cache["crn"]
+    rows = data if sort_key == "_row_num" else orders[(sort_key, order_dir)]
+
+    if search:
+        rows = [r for r in rows if search in r["_gstin_lc"] or search in r["_name_lc"]]
+    return len(data), rows
+
+
+def load_stats():
+    mtimes = _data_mtimes()
+    try:
+        with open(STATS_PATH, "r") as f:
+            stats = json.load(f)
+        if stats.get("mtimes") == mtimes and stats.get("version") == _CACHE_VERSION:
+            return stats
+    except Exception:
+        pass
+
+    dup = _load_dup_entry()
+    crn = _load_crn_entry()
+    stats = {"dup_display_cols": dup[2] if dup else [],
+             "dup_stats": dup[3] if dup else {},
+             "crn_stats": crn[2] if crn else {}}
+
+    loaded = [dup[0] if dup else 0, crn[0] if crn else 0]
+    if loaded != mtimes:
+        return stats
+    stats["mtimes"] = mtimes
+    stats["version"] = _CACHE_VERSION
+
+    _replace_file(STATS_PATH, lambda f: f.write(json.dumps(stats).encode("utf-8")))
+    return stats
 
 
 # ─── HTML TEMPLATE ────────────────────────────────────────────────────────────
@@ -438,85 +625,100 @@ HTML_TEMPLATE = """
 </html>
 """
 
+_INDEX_TPL = app.jinja_env.from_string(HTML_TEMPLATE)
+_TEMPLATE_CRC = zlib.crc32(HTML_TEMPLATE.encode("utf-8"))
+
 
 # ─── ROUTES ───────────────────────────────────────────────────────────────────
 
+def _data_etag(mtimes):
+    return "%s-%s-%s-%08x" % (mtimes[0], mtimes[1], _CACHE_VERSION, _TEMPLATE_CRC)
+
+
+def _cacheable(resp, etag):
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "public, max-age=60, must-revalidate"
+    return resp
+
+
+def _datatables_args(default_length):
+    args = flask_request.args
+    draw = args.get("draw", 1, type=int)
+    start = args.get("start", 0, type=int)
+    length = args.get("length", default_length, type=int)
+    search = args.get("search[value]", "").strip().lower()
+    return draw, start, length, search
+
+
 @app.route("/")
 def index():
-    dup_rows, display_cols, dup_stats = load_duplicates()
-    crn_data, crn_stats = load_crn_ratios()
+    stats = load_stats()
+    etag = _data_etag(stats["mtimes"]) if "mtimes" in stats else None
+    if etag and etag in flask_request.if_none_match:
+        return _cacheable(Response(status=304), etag)
 
-    return render_template_string(
-        HTML_TEMPLATE,
-        display_cols=display_cols,
+    has_dup_data = bool(stats["dup_stats"].get("total_rows"))
+    has_crn_data = bool(stats["crn_stats"].get("total_sellers"))
+
+    html = _INDEX_TPL.render(
+        display_cols=stats["dup_display_cols"],
         key_cols=KEY_COLS,
-        dup_stats=dup_stats if dup_rows else {},
-        has_dup_data=len(dup_rows) > 0,
-        crn_stats=crn_stats if crn_data else {},
-        has_crn_data=len(crn_data) > 0,
+        dup_stats=stats["dup_stats"] if has_dup_data else {},
+        has_dup_data=has_dup_data,
+        crn_stats=stats["crn_stats"] if has_crn_data else {},
+        has_crn_data=has_crn_data,
         csv_path=CSV_PATH,
     )
+    resp = Response(html, mimetype="text/html")
+    return _cacheable(resp, etag) if etag else resp
 
 
 @app.route("/api/duplicates")
 def api_duplicates():
     rows, _, _ = load_duplicates()
 
-    draw = int(flask_request.args.get("draw", 1))
-    start = int(flask_request.args.get("start", 0))
-    length = int(flask_request.args.get("length", 100))
-    search = flask_request.args.get("search[value]", "").strip().lower()
+    draw, start, length, search = _datatables_args(default_length=100)
 
     if search:
-        filtered = [r for r in rows if any(search in str(v).lower() for v in r.values() if v)]
+        filtered = [r for r in rows if search in r["_search_blob"]]
     else:
         filtered = rows
 
     page = filtered[start:start + length]
-    result = []
-    for i, row in enumerate(page):
-        r = {k: (v if v else "-") for k, v in row.items() if not k.startswith("_")}
-        r["_group_id"] = row.get("_group_id", 0)
-        r["_group_size"] = row.get("_group_size", 0)
-        r["_row_num"] = start + i + 1
-        result.append(r)
+    data = b",".join(b'%s,"_row_num":%d}' % (row["_json"], start + i + 1)
+                     for i, row in enumerate(page))
 
-    return jsonify({"draw": draw, "recordsTotal": len(rows),
-                     "recordsFiltered": len(filtered), "data": result})
+    body = b'{"draw":%d,"recordsTotal":%d,"recordsFiltered":%d,"data":[%s]}' % (
+        draw, len(rows), len(filtered), data)
+    return Response(body, mimetype="application/json")
 
 
 @app.route("/api/crn-ratio")
 def api_crn_ratio():
-    data, _ = load_crn_ratios()
+    entry = _load_crn_entry()
 
-    draw = int(flask_request.args.get("draw", 1))
-    start = int(flask_request.args.get("start", 0))
-    length = int(flask_request.args.get("length", 50))
-    search = flask_request.args.get("search[value]", "").strip().lower()
+    draw, start, length, search = _datatables_args(default_length=50)
 
     # Sort
-    order_col = int(flask_request.args.get("order[0][column]", 4))
-    order_dir = flask_request.args.get("order[0][dir]", "desc")
-    col_map = {0: "_row_num", 2: "gstin", 3: "name", 4: "crn_inv_ratio",
-               5: "inv_count", 6: "crn_count", 7: "dbn_count",
-               8: "total_inv_val", 9: "total_crn_val"}
-    sort_key = col_map.get(order_col, "crn_inv_ratio")
+    args = flask_request.args
+    order_col = args.get("order[0][column]", 4, type=int)
+    order_dir = "desc" if args.get("order[0][dir]", "desc") == "desc" else "asc"
+    sort_key = CRN_SORT_COLS.get(order_col, "crn_inv_ratio")
 
-    if search:
-        filtered = [r for r in data if search in r.get("gstin", "").lower() or search in r.get("name", "").lower()]
+    if entry is None:
+        total, filtered = 0, []
     else:
-        filtered = data
+        total, filtered = _crn_view(search, sort_key, order_dir, entry[0])
 
-    if sort_key != "_row_num":
-        filtered = sorted(filtered, key=lambda x: x.get(sort_key, 0),
-                          reverse=(order_dir == "desc"))
-
-    page = filtered[start:start + length]
-    for i, row in enumerate(page):
-        row["_row_num"] = start + i + 1
+    page = []
+    for i, row in enumerate(filtered[start:start + length]):
+        r = {k: v for k, v in row.items() if not k.startswith("_")}
+        r["_row_num"] = start + i + 1
+        page.append(r)
 
-    return jsonify({"draw": draw, "recordsTotal": len(data),
-                     "recordsFiltered": len(filtered), "data": page})
+    body = orjson.dumps({"draw": draw, "recordsTotal": total,
+                         "recordsFiltered": len(filtered), "data": page})
+    return Response(body, mimetype="application/json")
 
 
 @app.route("/export/duplicates")
@@ -533,22 +735,30 @@ def export_crn_ratio():
     if not data:
         return "No data", 404
 
-    import io
-    output = io.StringIO()
-    writer = csv.DictWriter(output, fieldnames=["gstin", "name", "crn_inv_ratio",
-                                                  "inv_count", "crn_count", "dbn_count",
-                                                  "total_inv_val", "total_crn_val"])
-    writer.writeheader()
-    writer.writerows(data)
-    output.seek(0)
-
-    from flask import Response
-    return Response(output.getvalue(), mimetype="text/csv",
+    def generate():
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=["gstin", "name", "crn_inv_ratio",
+                                                      "inv_count", "crn_count", "dbn_count",
+                                                      "total_inv_val", "total_crn_val"],
+                                extrasaction="ignore")
+        writer.writeheader()
+        for i in range(0, len(data), EXPORT_CHUNK_ROWS):
+            writer.writerows(data[i:i + EXPORT_CHUNK_ROWS])
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+
+    return Response(generate(), mimetype="text/csv",
                     headers={"Content-Disposition": "attachment;filename=crn_inv_ratio.csv"})
 
 
 if __name__ == "__main__":
     os.makedirs(DATA_DIR, exist_ok=True)
-    
+
     print("\nStarting Fraud Detection Dashboard at http://localhost:5000")
-    app.run(host="127.0.0.1", port=5000, debug=True)
+    if "--debug" in sys.argv:
+        app.run(host="127.0.0.1", port=5000, debug=True)
+    else:
+        # Thread-safe because reloads swap whole _cache entries.
+        from waitress import serve
+        serve(app, host="127.0.0.1", port=5000, threads=8)